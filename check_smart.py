@@ -2,48 +2,70 @@
 """Nagios-like plugin to check S.M.A.R.T. data"""
 import argparse
 import collections
+import concurrent.futures
 import hashlib
 import json
 import logging
+import os
 import pathlib
 import pickle
-import re
 import shlex
+import stat
 import subprocess
 import sys
+import tempfile
 
 import nagiosplugin  # type: ignore
 
+try:
+    from orjson import loads as json_loads  # type: ignore
+except ImportError:
+    from json import loads as json_loads  # type: ignore
+
 logger = logging.getLogger("nagiosplugin")
 
 
+def _index_exclusions(exclusions):
+    # Several exclusions can share a match, their metrics are merged
+    index = {}
+    for exclusion in exclusions:
+        for match in exclusion["match"].items():
+            index.setdefault(match, set()).update(exclusion["metrics"])
+    return {match: frozenset(metrics) for match, metrics in index.items()}
+
+
 class Smart(nagiosplugin.Resource):
-    CHECKED_METRICS = (
-        "ata_smart_error_log_count",
-        "Calibration_Retry_Count",
-        "critical_comp_time",
-        "critical_warning",
-        "Current_Pending_Sector",
-        "CRC_Error_Count",
-        "ECC_Error_Rate",
-        "Erase_Fail_Count_Total",
-        "G-Sense_Error_Rate",
-        "Load_Retry_Count",
-        "media_errors",
-        "Multi_Zone_Error_Rate",
-        "Offline_Uncorrectable",
-        "Program_Fail_Cnt_Total",
-        "Raw_Read_Error_Rate",
-        "Reallocated_Event_Count",
-        "Reallocated_Sector_Ct",
-        "Runtime_Bad_Block",
-        "Seek_Error_Rate",
-        "Spin_Retry_Count",
-        "UDMA_CRC_Error_Count",
-        "Uncorrectable_Error_Cnt",
-        "Used_Rsvd_Blk_Cnt_Tot",
-        "warning_temp_time",
+    CHECKED_METRICS = frozenset(
+        (
+            "ata_smart_error_log_count",
+            "Calibration_Retry_Count",
+            "critical_comp_time",
+            "critical_warning",
+            "Current_Pending_Sector",
+            "CRC_Error_Count",
+            "ECC_Error_Rate",
+            "Erase_Fail_Count_Total",
+            "G-Sense_Error_Rate",
+            "Load_Retry_Count",
+            "media_errors",
+            "Multi_Zone_Error_Rate",
+            "Offline_Uncorrectable",
+            "Program_Fail_Cnt_Total",
+            "Raw_Read_Error_Rate",
+            "Reallocated_Event_Count",
+            "Reallocated_Sector_Ct",
+            "Runtime_Bad_Block",
+            "Seek_Error_Rate",
+            "Spin_Retry_Count",
+            "UDMA_CRC_Error_Count",
+            "Uncorrectable_Error_Cnt",
+            "Used_Rsvd_Blk_Cnt_Tot",
+            "warning_temp_time",
+        )
     )
+    # Only retrieve the data we check instead of everything returned by -x,
+    # each log requires additional commands to be sent to the device
+    SMARTCTL_OPTIONS = ("-i", "-H", "-A", "-l", "xerror,1", "-l", "xselftest,selftest")
     CHECK_EXCLUSIONS = [
         {
             "match": {"model_family": "Seagate Exos X16"},
@@ -53,155 +75,234 @@ class Smart(nagiosplugin.Resource):
             ],
         }
     ]
+    # Status and message for each bit of smartctl's exit status that doesn't abort the check
+    EXIT_STATUS_MESSAGES = {
+        0x04: ("warning", "a command failed or a checksum error was found"),
+        0x08: ("critical", "is in failing state"),
+        0x10: ("critical", "has prefail attributes below threshold"),
+        0x20: ("warning", "had prefail attributes below threshold at some point"),
+        0x80: ("warning", "returned errors during the last self-test"),
+    }
+    # Characters replaced in serial numbers, applied in a single pass with str.translate
+    SERIAL_TRANSLATION = str.maketrans({"_": "-"})
+    # Must be incremented when the format of the state file changes
+    STATE_VERSION = 1
+    # Maps each (key, value) match of CHECK_EXCLUSIONS to the metrics it excludes
+    EXCLUSION_INDEX = _index_exclusions(CHECK_EXCLUSIONS)
 
     def __init__(self, args, unique_hash):
         self.args = args
         self.unique_hash = unique_hash
         self.metrics = {}
         self.old_metrics = {}
-
-    def _exclude_metric(self, serial, smart_data, metric):
-        for exclusion in self.CHECK_EXCLUSIONS:
-            for key, value in exclusion["match"].items():
-                if smart_data.get(key) == value and metric in exclusion["metrics"]:
-                    logger.debug(
-                        "[%s] Ignoring increment in metric %s because %s = %s",
-                        serial,
-                        metric,
-                        key,
-                        value,
-                    )
-                    return True
-        return False
-
-    def check_metric(self, smart_data, serial, metric, value, temperature=False):
+        # Resolve symlinks once, devices are then compared as strings
+        self.selected_devices = frozenset(os.path.realpath(d) for d in args.devices)
+        self.excluded_devices = frozenset(os.path.realpath(d) for d in args.exclude_devices)
+        self.devices = None
+
+    def _get_excluded_metrics(self, smart_data):
+        # Exclusions only depend on the device, map its excluded metrics to the reason why
+        excluded_metrics = dict.fromkeys(self.args.exclude_metrics, "of --exclude-metrics")
+        for (key, value), metrics in self.EXCLUSION_INDEX.items():
+            if smart_data.get(key) == value:
+                excluded_metrics.update(dict.fromkeys(metrics, f"{key} = {value}"))
+        return excluded_metrics
+
+    def check_metric(self, excluded_metrics, serial, metric, value, temperature=False):
         # pylint: disable=too-many-arguments
+        # The metrics are returned as a list instead of being yielded
+        # to avoid creating a generator for every attribute
         # Ignore all raw temperature metrics because
         # we obtain them from the "Current temperature" section
-        if not temperature and re.match(r"^temperature($|_)", metric, flags=re.I):
-            return
-        try:
-            values = self.old_metrics[serial][metric]
-        except KeyError:
-            values = []
-        values.append(value)
-        if len(values) > (self.args.max_attempts + 1):
-            values.pop(0)
-        self.metrics[serial][metric] = values
-        metric_str = f"[{serial}] {metric} = {value}"
+        if not temperature:
+            metric_lower = metric.lower()
+            if metric_lower == "temperature" or metric_lower.startswith("temperature_"):
+                return []
+        out = []
+        # Only checked metrics need a history of their values
         if metric in self.CHECKED_METRICS:
+            try:
+                old_values = self.old_metrics[serial][metric]
+            except KeyError:
+                old_values = ()
+            # The oldest values are discarded when appending to a full deque
+            values = collections.deque(old_values, maxlen=self.args.max_attempts + 1)
+            values.append(value)
+            self.metrics.setdefault(serial, {})[metric] = values
             if self.args.checked_metrics:
-                print(metric_str)
+                print(f"[{serial}] {metric} = {value}")
             first_value = values[0]
             max_value = max(values)
-            if max_value > first_value and not self._exclude_metric(serial, smart_data, metric):
-                yield nagiosplugin.Metric(
-                    "warning",
-                    {"increment": (serial, metric, first_value, max_value)},
-                    context="metadata",
-                )
+            if max_value > first_value:
+                if metric in excluded_metrics:
+                    logger.debug(
+                        "[%s] Ignoring increment in metric %s because %s",
+                        serial,
+                        metric,
+                        excluded_metrics[metric],
+                    )
+                else:
+                    out.append(
+                        nagiosplugin.Metric(
+                            "warning",
+                            {"increment": (serial, metric, first_value, max_value)},
+                            context="metadata",
+                        )
+                    )
         elif self.args.non_checked_metrics:
-            print(metric_str)
-        logger.info(metric_str)
-        yield nagiosplugin.Metric(f"{serial}_{metric}", value, context="smart_attributes")
+            print(f"[{serial}] {metric} = {value}")
+        # Let logging format the message only if it is emitted
+        logger.info("[%s] %s = %s", serial, metric, value)
+        if not self.args.no_perfdata:
+            out.append(nagiosplugin.Metric(f"{serial}_{metric}", value, context="smart_attributes"))
+        return out
+
+    @staticmethod
+    def _read_sysfs_int(path):
+        # sysfs attributes only contain a few bytes, a single read
+        # is enough and avoids creating a buffered file object
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            return int(os.read(fd, 64))
+        finally:
+            os.close(fd)
 
     def _list_devices(self):
+        # Devices are only looked up once if probe() is called several times
+        if self.devices is None:
+            # Devices were explicitly selected, there is no need to walk /sys/block
+            if self.selected_devices:
+                self.devices = tuple(self._find_selected_devices())
+            else:
+                self.devices = tuple(self._find_devices())
+        return self.devices
+
+    def _find_selected_devices(self):
         devices = []
-        selected_devices_absolute = []
-        selected_devices_absolute = [d.resolve() for d in self.args.devices]
-        excluded_devices_absolute = [d.resolve() for d in self.args.exclude_devices]
-        for path in pathlib.Path("/sys/block/").iterdir():
-            if not (path / "device").is_dir():
-                continue
+        for dev_path in sorted(self.selected_devices):
             try:
-                with (path / "device/type").open() as f:
-                    scsi_type = int(f.read())
-            # If there is no type file, assume it is a disk
-            # https://github.com/karelzak/util-linux/blob/2089538a/misc-utils/lsblk.c#L431
-            except FileNotFoundError:
-                scsi_type = 0
-            with (path / "size").open() as f:
-                dev_size = int(f.read())
-            dev_path = pathlib.Path("/dev") / path.name
-
-            if self.args.skip_removable:
+                if stat.S_ISBLK(os.stat(dev_path).st_mode):
+                    devices.append(pathlib.Path(dev_path))
+            except OSError:
+                pass
+        return devices
+
+    def _find_devices(self):
+        devices = []
+        with os.scandir("/sys/block") as it:
+            for entry in it:
+                if not os.path.isdir(f"{entry.path}/device"):
+                    continue
                 try:
-                    with (path / "removable").open() as f:
-                        removable = int(f.read())
-                    if removable == 1:
+                    scsi_type = self._read_sysfs_int(f"{entry.path}/device/type")
+                # If there is no type file, assume it is a disk
+                # https://github.com/karelzak/util-linux/blob/2089538a/misc-utils/lsblk.c#L431
+                except FileNotFoundError:
+                    scsi_type = 0
+                dev_size = self._read_sysfs_int(f"{entry.path}/size")
+                dev_path = f"/dev/{entry.name}"
+
+                if self.args.skip_removable:
+                    try:
+                        if self._read_sysfs_int(f"{entry.path}/removable") == 1:
+                            continue
+                    # The removable attribute is missing or invalid, keep the device
+                    except (OSError, ValueError):
+                        pass
+
+                # SCSI_TYPE_DISK, see
+                # https://github.com/torvalds/linux/blob/d1fdb6d8/include/scsi/scsi_proto.h#L251
+                if scsi_type == 0x00 and dev_size != 0:
+                    # Device is excluded
+                    if dev_path in self.excluded_devices:
                         continue
-                except Exception:  # pylint: disable=broad-except
-                    pass
-
-            # SCSI_TYPE_DISK, see
-            # https://github.com/torvalds/linux/blob/d1fdb6d8/include/scsi/scsi_proto.h#L251
-            if scsi_type == 0x00 and dev_size != 0:
-                # Device is excluded
-                if dev_path in excluded_devices_absolute:
-                    continue
-                # There is a list of included devices and this one isn't in it
-                if self.args.devices and dev_path not in selected_devices_absolute:
-                    continue
-                devices.append(dev_path)
+                    devices.append(pathlib.Path(dev_path))
         return devices
 
     def _parse_exit_status(self, device, serial, exit_status):
-        def _make_status_message(status, message):
-            info = (serial or device, message)
-            return nagiosplugin.Metric(status, {"status": info}, context="metadata")
-
-        bits = [(exit_status >> _) & 1 for _ in range(8)]
-        if bits[0]:
+        if exit_status & 0x01:
             raise nagiosplugin.CheckError(f"Command line did not parse for {device}")
-        if bits[1]:
+        if exit_status & 0x02:
             raise nagiosplugin.CheckError(f"Device open failed for {device}")
-        if bits[2]:
-            if not self.args.ignore_failing_commands:
-                yield _make_status_message(
-                    "warning", "a command failed or a checksum error was found"
-                )
-        if bits[3]:
-            yield _make_status_message("critical", "is in failing state")
-        if bits[4]:
-            yield _make_status_message("critical", "has prefail attributes below threshold")
-        if bits[5]:
-            yield _make_status_message(
-                "warning", "had prefail attributes below threshold at some point"
-            )
-        if bits[7]:
-            yield _make_status_message("warning", "returned errors during the last self-test")
+        if self.args.ignore_failing_commands:
+            exit_status &= ~0x04
+        for bit, (status, message) in self.EXIT_STATUS_MESSAGES.items():
+            if exit_status & bit:
+                info = (serial or device, message)
+                yield nagiosplugin.Metric(status, {"status": info}, context="metadata")
 
     def _load_cookie(self, state_file):
-        with nagiosplugin.Cookie(str(state_file)) as cookie:
-            try:
-                self.old_metrics = cookie["metrics"]
-                logger.info("Loaded old metrics from %s", state_file)
-            except KeyError:
-                yield nagiosplugin.Metric(
-                    "warning",
-                    {"message": f"No data in state file {state_file}, first run?"},
-                    context="metadata",
-                )
+        try:
+            with open(state_file, "rb") as f:
+                # Only unpickle data that nobody else could have tampered with
+                file_stat = os.fstat(f.fileno())
+                if file_stat.st_uid != os.geteuid() or file_stat.st_mode & (
+                    stat.S_IWGRP | stat.S_IWOTH
+                ):
+                    raise nagiosplugin.CheckError(
+                        f"State file {state_file} must be owned by the current user"
+                        " and must not be writable by others"
+                    )
+                state = pickle.load(f)
+        except FileNotFoundError:
+            yield nagiosplugin.Metric(
+                "warning",
+                {"message": f"No data in state file {state_file}, first run?"},
+                context="metadata",
+            )
+            return
+        # ValueError is raised for pickle protocols unknown to this interpreter
+        except (pickle.UnpicklingError, EOFError, ValueError):
+            state = None
+        # Discard states written in another format, e.g. by an older version of the check
+        if not isinstance(state, dict) or state.get("version") != self.STATE_VERSION:
+            yield nagiosplugin.Metric(
+                "warning",
+                {"message": f"Invalid data in state file {state_file}, ignoring it"},
+                context="metadata",
+            )
+            return
+        self.old_metrics = state["metrics"]
+        logger.info("Loaded old metrics from %s", state_file)
 
     def _save_cookie(self, state_file):
-        with nagiosplugin.Cookie(str(state_file)) as cookie:
-            cookie["metrics"] = self.metrics
+        # Write to a temporary file and rename it so that the state file is replaced atomically
+        fd, tmp_file = tempfile.mkstemp(dir=state_file.parent, prefix=f"{state_file.name}.")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                state = {"version": self.STATE_VERSION, "metrics": self.metrics}
+                # Protocol 4 can be read by all the supported Python versions
+                pickle.dump(state, f, protocol=4)
+            os.replace(tmp_file, state_file)
+        except BaseException:
+            os.unlink(tmp_file)
+            raise
 
     def _get_device_smart_data(self, device):
         if self.args.load_json:
-            smart_data = json.load(sys.stdin)
+            smart_data = json_loads(sys.stdin.buffer.read())
         else:
-            command = ["sudo", "-n", "smartctl", "--json=s", "-x", str(device)]
-            logger.info("Running command: %s", " ".join(shlex.quote(_) for _ in command))
+            command = ["sudo", "-n", "smartctl", "--json=s"]
+            # Do not spin up disks, smartctl reports them as being in standby mode instead
+            if not self.args.wake_disks:
+                command.extend(("-n", "standby,0"))
+            command.extend(("-x",) if self.args.full else self.SMARTCTL_OPTIONS)
+            command.append(str(device))
+            if logger.isEnabledFor(logging.INFO):
+                # shlex.join() would require Python 3.8
+                logger.info("Running command: %s", " ".join(shlex.quote(_) for _ in command))
+            # Keep the output as bytes, both parsers accept it without decoding it first
             proc = subprocess.run(  # pylint: disable=subprocess-run-check
-                command, capture_output=True, universal_newlines=True
+                command, capture_output=True
             )
             try:
-                smart_data = json.loads(proc.stdout)
+                smart_data = json_loads(proc.stdout)
+            # orjson.JSONDecodeError is a subclass of json.JSONDecodeError
             except json.JSONDecodeError as e:
+                stdout = proc.stdout.decode(errors="replace")
+                stderr = proc.stderr.decode(errors="replace")
                 raise nagiosplugin.CheckError(
-                    f"Failed to decode smartctl's JSON output: {proc.stdout!r};"
-                    f" stderr: {proc.stderr!r}"
+                    f"Failed to decode smartctl's JSON output: {stdout!r}; stderr: {stderr!r}"
                 ) from e
         return smart_data
 
@@ -213,68 +314,109 @@ class Smart(nagiosplugin.Resource):
                     f"smartctl returned an error for {device}: {msg['string']}"
                 )
 
-    def _handle_other_metrics(self, smart_data, serial):
-        if smart_data["device"]["type"] == "sat":
+    @classmethod
+    def _is_in_standby(cls, smart_data):
+        # smartctl exits without checking devices in a low-power mode when -n is used
+        return any(
+            msg["string"].startswith("Device is in ")
+            for msg in smart_data["smartctl"].get("messages", [])
+        )
+
+    @staticmethod
+    def _iter_attributes(smart_data):
+        # Yield the name and raw value of each attribute, whatever the device type
+        dev_type = smart_data["device"]["type"]
+        if dev_type == "sat":
             for attr in smart_data["ata_smart_attributes"]["table"]:
-                yield from self.check_metric(smart_data, serial, attr["name"], attr["raw"]["value"])
-        elif smart_data["device"]["type"] == "nvme":
+                yield attr["name"], attr["raw"]["value"]
+        elif dev_type == "nvme":
             for attr, attr_val in smart_data["nvme_smart_health_information_log"].items():
                 if isinstance(attr_val, list):
                     for i, val in enumerate(attr_val):
-                        yield from self.check_metric(smart_data, serial, f"{attr}_{i}", val)
+                        yield f"{attr}_{i}", val
                 else:
-                    yield from self.check_metric(smart_data, serial, attr, attr_val)
+                    yield attr, attr_val
 
-    def _probe_device(self, device):
-        smart_data = self._get_device_smart_data(device)
+    def _probe_device(self, device, smart_data):
         self._handle_smart_messages(device, smart_data)
         # We want to be able to split perfdata on the first underscore to extract the serial
-        try:
-            serial = smart_data["serial_number"].replace("_", "-")
-        except KeyError:
-            serial = None
+        serial = smart_data.get("serial_number")
+        if serial is not None:
+            serial = serial.translate(self.SERIAL_TRANSLATION)
         yield from self._parse_exit_status(device, serial, smart_data["smartctl"]["exit_status"])
+        # Without perfdata, a healthy device wouldn't return any result
+        if self.args.no_perfdata:
+            yield nagiosplugin.Metric("ok", {"device": serial or device}, context="metadata")
+        out = []
+        excluded_metrics = self._get_excluded_metrics(smart_data)
         # Create a metric based on the number of errors in the log
         if "ata_smart_error_log" in smart_data:
-            yield from self.check_metric(
-                smart_data,
+            out += self.check_metric(
+                excluded_metrics,
                 serial,
                 "ata_smart_error_log_count",
                 smart_data["ata_smart_error_log"]["extended"]["count"],
             )
         # Parse temperature separately because sometimes
         # the raw value includes "Min/Max" strings and isn't usable
-        try:
-            yield from self.check_metric(
-                smart_data,
-                serial,
-                "temperature",
-                smart_data["temperature"]["current"],
-                temperature=True,
+        current_temperature = smart_data.get("temperature", {}).get("current")
+        if current_temperature is not None:
+            out += self.check_metric(
+                excluded_metrics, serial, "temperature", current_temperature, temperature=True
             )
-        except Exception:  # pylint: disable=broad-except
-            pass
         # Parse all other metrics
-        yield from self._handle_other_metrics(smart_data, serial)
+        # Bind the method once rather than looking it up for every attribute
+        check_metric = self.check_metric
+        for metric, value in self._iter_attributes(smart_data):
+            out += check_metric(excluded_metrics, serial, metric, value)
+        yield from out
+
+    def _probe_devices(self, devices_smart_data):
+        # Yield the metrics of all devices, return whether any of them was in standby mode
+        in_standby = False
+        for dev, smart_data in devices_smart_data:
+            if self._is_in_standby(smart_data):
+                logger.info("Skipping %s which is in standby mode", dev)
+                in_standby = True
+                yield nagiosplugin.Metric("ok", {"standby": dev}, context="metadata")
+            else:
+                yield from self._probe_device(dev, smart_data)
+        return in_standby
 
     def probe(self):
-        if not self.args.load_json:
-            valid_devices = self._list_devices()
-            if not valid_devices:
-                devices = ", ".join(str(_) for _ in self.args.devices)
-                raise nagiosplugin.CheckError(f"Could not find any device matching {devices}")
-            if self.args.list_devices:
-                for dev in sorted(valid_devices):
-                    print(f"Found device {dev}")
-                return
-        self.metrics = collections.defaultdict(dict)
-        state_file = pathlib.Path("/var/tmp") / f".check_smart_{self.unique_hash}"
-        yield from self._load_cookie(state_file)
+        self.metrics = {}
+        # Data loaded from stdin doesn't come from the monitored devices, leave their state alone
         if self.args.load_json:
-            valid_devices = [None]
-        for dev in valid_devices:
-            yield from self._probe_device(dev)
-        self._save_cookie(state_file)
+            yield from self._probe_devices([(None, self._get_device_smart_data(None))])
+            return
+        valid_devices = self._list_devices()
+        if not valid_devices:
+            devices = ", ".join(str(_) for _ in self.args.devices)
+            raise nagiosplugin.CheckError(f"Could not find any device matching {devices}")
+        if self.args.list_devices:
+            for dev in sorted(valid_devices):
+                print(f"Found device {dev}")
+            return
+        state_file = self.args.state_dir / f".check_smart_{self.unique_hash}"
+        state_warnings = list(self._load_cookie(state_file))
+        yield from state_warnings
+        # smartctl spends most of its time waiting for the devices, run all of them
+        # concurrently then process their output sequentially to keep metrics ordered
+        with concurrent.futures.ThreadPoolExecutor(
+            max_workers=min(len(valid_devices), self.args.jobs)
+        ) as executor:
+            devices_smart_data = list(
+                zip(valid_devices, executor.map(self._get_device_smart_data, valid_devices))
+            )
+        in_standby = yield from self._probe_devices(devices_smart_data)
+        # The serial numbers of devices in standby mode are unknown, keep all the histories
+        # that were not updated so that they are still available when the devices wake up
+        if in_standby:
+            for serial, serial_metrics in self.old_metrics.items():
+                self.metrics.setdefault(serial, serial_metrics)
+        # Histories stop changing once values are stable, don't rewrite identical state
+        if state_warnings or self.metrics != self.old_metrics:
+            self._save_cookie(state_file)
 
 
 class SmartSummary(nagiosplugin.Summary):
@@ -285,28 +427,36 @@ class SmartSummary(nagiosplugin.Summary):
         # We handle verbose with the logger, the summary doesn't change based on verbosity
         pass
 
+    @classmethod
+    def _non_ok_results(cls, results):
+        # Group results by state in a single pass instead of sorting all of them
+        results_by_state = {}
+        for result in results:
+            if result.state != nagiosplugin.Ok:
+                results_by_state.setdefault(result.state, []).append(result)
+        # Worst result first
+        for state in sorted(results_by_state, reverse=True):
+            yield from results_by_state[state]
+
     @classmethod
     def _handle_result(cls, result, messages, increments, disk_statuses):
-        if result.state == nagiosplugin.Ok:
-            return
         if "increment" in result.hint:
             serial, metric, old_val, new_val = result.hint["increment"]
-            increments[serial][metric] = (old_val, new_val)
+            increments.setdefault(serial, {})[metric] = (old_val, new_val)
         elif "message" in result.hint:
             messages.append(result.hint["message"])
         elif "status" in result.hint:
             serial, msg = result.hint["status"]
-            disk_statuses[serial].append(msg)
+            disk_statuses.setdefault(serial, []).append(msg)
         # Handle all other messages (including those originating from CheckError)
         else:
             messages.append(result.hint)
 
     def problem(self, results):
         messages = []
-        increments = collections.defaultdict(dict)
-        disk_statuses = collections.defaultdict(list)
-        # Worst result first
-        for result in sorted(results, key=lambda x: x.state, reverse=True):
+        increments = {}
+        disk_statuses = {}
+        for result in self._non_ok_results(results):
             self._handle_result(result, messages, increments, disk_statuses)
         for serial, status_messages in disk_statuses.items():
             messages.append(f"Disk {serial}: {', '.join(status_messages)}")
@@ -322,6 +472,8 @@ class SmartSummary(nagiosplugin.Summary):
 class MetaDataContext(nagiosplugin.Context):
     # pylint: disable=inconsistent-return-statements
     def evaluate(self, metric, resource):
+        if metric.name == "ok":
+            return self.result_cls(nagiosplugin.Ok, metric.value)
         if metric.name == "warning":
             return self.result_cls(nagiosplugin.Warn, metric.value)
         if metric.name == "critical":
@@ -374,6 +526,31 @@ def parse_args():
         action="store_true",
         default=False,
     )
+    parser.add_argument(
+        "--wake-disks",
+        help="check disks in standby mode instead of skipping them, this spins them up",
+        action="store_true",
+        default=False,
+    )
+    parser.add_argument(
+        "--state-dir",
+        help="directory where the state file is stored, e.g. /dev/shm to keep it in memory",
+        type=pathlib.Path,
+        default=pathlib.Path("/var/tmp"),
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        help="maximum number of smartctl commands to run concurrently",
+        type=int,
+        default=8,
+    )
+    parser.add_argument(
+        "--no-perfdata",
+        help="do not output performance data for each attribute",
+        action="store_true",
+        default=False,
+    )
     debugging_options = parser.add_argument_group(
         "Debugging options", description="These options can be used for debugging purposes"
     )
@@ -389,7 +566,14 @@ def parse_args():
     )
     debugging_options.add_argument(
         "--load-json",
-        help="load smartctl's JSON output from stdin",
+        help="load smartctl's JSON output from stdin, the state file is neither read nor written",
+        action="store_true",
+        default=False,
+    )
+    debugging_options.add_argument(
+        "--full",
+        help="run smartctl with -x to retrieve all the available data,"
+        " this is slower and requires different sudo rules",
         action="store_true",
         default=False,
     )
@@ -409,6 +593,8 @@ def parse_args():
     args = parser.parse_args()
     if args.list_devices and (args.devices or args.exclude_devices):
         parser.error("--list-devices can not be used with -D/--devices or -X/--exclude-devices")
+    if args.jobs < 1:
+        parser.error("-j/--jobs must be at least 1")
     return args
 
 
@@ -417,9 +603,9 @@ def main(args):
     # Unique identifier used to store check state
     relevant_args = []
     for arg, arg_val in sorted(vars(args).items()):
-        if arg not in ("verbose",):
+        if arg not in ("jobs", "no_perfdata", "state_dir", "verbose", "wake_disks"):
             relevant_args.append((arg, arg_val))
-    args_hash = hashlib.sha1(pickle.dumps(relevant_args)).hexdigest()
+    args_hash = hashlib.blake2b(repr(relevant_args).encode(), digest_size=10).hexdigest()
     check = nagiosplugin.Check(
         Smart(args, args_hash),
         nagiosplugin.ScalarContext("smart_attributes"),